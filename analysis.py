@@ -12,89 +12,166 @@ EMS刺激トレーニング前後での反応速度変化を検証する
   6. フェーズ2後測定 (EMS OFF, ×30)
 """
 
+import io
 import os
 import re
+import json
+import argparse
 import warnings
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-from scipy import stats
-import matplotlib.pyplot as plt
-import matplotlib
 
-# 日本語フォント設定（Windows）
-matplotlib.rcParams['font.family'] = 'MS Gothic'
-matplotlib.rcParams['axes.unicode_minus'] = False
+# scipy・matplotlib と任意依存の pyarrow・polars・numba は起動が重いので、使う関数の中で読み込む
+# （matplotlib の初期設定は _import_pyplot を参照）
+
+# 出力解像度（確認用に素早く描くときは環境変数 PLOT_DPI=100 などで下げる）
+PLOT_DPI = int(os.environ.get('PLOT_DPI', 150))
 warnings.filterwarnings('ignore', category=UserWarning)
 
+# Parquetキャッシュ（pyarrowが無い環境では毎回CSVをパースする）
+# ここでは有無だけ調べ、読み込みは pandas の Parquet 入出力と _read_trials_arrow に任せる
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+# 試行数の多いファイル向けに、トライアル部分を pyarrow のCSVリーダーで読む（FAST_IO=1 で有効）
+FAST_IO = os.environ.get('FAST_IO') == '1' and HAS_PYARROW
+
+# 外れ値除去を numba のJITカーネルで行う（USE_NUMBA=1 で有効）
+# 1相30試行程度ではnumbaの読み込み（約0.7秒）の方が重いので、既定はNumPy実装
+USE_NUMBA = os.environ.get('USE_NUMBA') == '1'
+
 # ============================================================
 # データ読み込み
 # ============================================================
 DATA_DIR = os.path.join(os.path.dirname(__file__), "ExperimentData")
+_FILENAME_RE = re.compile(r'Data_(\w+)_(EMS_\w+)_(\d{8}_\d{6})\.csv')
+
+
+TRIAL_COLUMNS = ['Trial', 'ReactionTime_ms']
 
 
 def parse_csv(filepath):
     """カスタムCSV形式をパースし、設定辞書とトライアルDataFrameを返す"""
+    # ファイル全体を1回だけ読み、マーカー位置で切り出す
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    s = data.find(b'--- Settings ---')
+    t = data.find(b'Trial,Direction,', max(s, 0))
+    e = data.find(b'--- Summary ---', max(t, 0))
+    if e < 0:
+        e = len(data)
+
     settings = {}
-    trials = []
-    in_settings = False
-    in_trials = False
-
-    with open(filepath, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith('--- Settings ---'):
-                in_settings = True
-                in_trials = False
-                continue
-            if line.startswith('--- Summary ---'):
-                break
-            if line.startswith('Trial,Direction,'):
-                in_trials = True
-                in_settings = False
-                continue
-            if in_settings and ',' in line:
-                key, val = line.split(',', 1)
-                settings[key.strip()] = val.strip()
-            if in_trials and line:
-                parts = line.split(',')
-                if len(parts) >= 3:
-                    trials.append({
-                        'Trial': int(parts[0]),
-                        'Direction': parts[1],
-                        'ReactionTime_ms': float(parts[2]),
-                    })
-
-    df = pd.DataFrame(trials)
+    if s >= 0:
+        block = data[s:t if t >= 0 else e].decode('utf-8').splitlines()[1:]
+        pairs = [line.split(',', 1) for line in block if ',' in line]
+        settings = {key.strip(): val.strip() for key, val in pairs}
+
+    if t < 0:
+        return settings, pd.DataFrame(columns=TRIAL_COLUMNS)
+
+    if FAST_IO:
+        return settings, _read_trials_arrow(data[t:e])
+
+    # トライアル部分（1ファイル数十行）は read_csv の初期化コストの方が大きいので、
+    # 分割して np.fromiter で数値列だけを作る（Direction列は分析で使わないので読まない）
+    rows = [line.split(b',') for line in data[t:e].splitlines()[1:]]
+    rows = [r for r in rows if len(r) >= 3]
+    df = pd.DataFrame({
+        'Trial': np.fromiter((int(r[0]) for r in rows), dtype=np.int32, count=len(rows)),
+        'ReactionTime_ms': np.fromiter((float(r[2]) for r in rows), dtype=np.float64, count=len(rows)),
+    })
+    return settings, df
+
+
+def _read_trials_arrow(block):
+    """トライアル部分（ヘッダー行から）を pyarrow のマルチスレッドCSVリーダーで読む"""
+    # ヘッダーは 'ReactionTime(ms)' のように書かれるので、列位置で名前を取り出す
+    header = block[:block.find(b'\n')].decode('utf-8').strip().split(',')
+    trial_col, rt_col = header[0], header[2]
+    import pyarrow
+    import pyarrow.csv as pv
+    table = pv.read_csv(
+        io.BytesIO(block),
+        # 記録中に落ちたセッションでは最終行が途中で切れる（例: '3,L'）ので、通常経路と同じく読み飛ばす
+        parse_options=pv.ParseOptions(invalid_row_handler=lambda row: 'skip'),
+        convert_options=pv.ConvertOptions(
+            include_columns=[trial_col, rt_col],
+            column_types={trial_col: pyarrow.int32(), rt_col: pyarrow.float64()},
+        ),
+    )
+    return pd.DataFrame({
+        'Trial': table.column(trial_col).to_numpy(),
+        'ReactionTime_ms': table.column(rt_col).to_numpy(),
+    })
+
+
+# キャッシュの形式。parse_csv の出力（設定辞書・列構成・型）を変えたら必ず上げる
+CACHE_VERSION = 2
+
+
+def load_csv_cached(filepath):
+    """
+    parse_csv の結果を <file>.parquet + <file>.meta.json にキャッシュする
+    CSVより新しく、CACHE_VERSION が一致するキャッシュがあればパースを省略して読み込む
+    """
+    if not HAS_PYARROW:
+        return parse_csv(filepath)
+
+    cache = filepath + '.parquet'
+    meta = filepath + '.meta.json'
+    if (os.path.exists(cache) and os.path.exists(meta)
+            and os.path.getmtime(cache) >= os.path.getmtime(filepath)):
+        # 壊れた・書きかけのキャッシュ（ArrowInvalid / JSONDecodeError は ValueError）はCSVから作り直す
+        try:
+            with open(meta, 'r', encoding='utf-8') as f:
+                meta_data = json.load(f)
+            # 旧形式（設定辞書のみ）や別バージョンのパーサが書いたキャッシュは作り直す
+            if meta_data.get('cache_version') == CACHE_VERSION:
+                return meta_data['settings'], pd.read_parquet(cache, engine='pyarrow')
+        except (OSError, ValueError):
+            pass
+
+    settings, df = parse_csv(filepath)
+    try:
+        df.to_parquet(cache, engine='pyarrow', index=False)
+        with open(meta, 'w', encoding='utf-8') as f:
+            json.dump({'cache_version': CACHE_VERSION, 'settings': settings}, f, ensure_ascii=False)
+    except OSError:
+        pass  # 書き込めない場合はキャッシュなしで続行
     return settings, df
 
 
 def load_all_data():
     """全被験者のデータを構造化して読み込む"""
-    files = sorted(os.listdir(DATA_DIR))
+    with os.scandir(DATA_DIR) as it:
+        entries = sorted((e for e in it
+                          if e.name.endswith('.csv') and e.is_file()),
+                         key=lambda e: e.name)
 
     # 被験者ごとにグループ化
     subjects = {}
-    for f in files:
-        if not f.endswith('.csv'):
-            continue
-        match = re.match(r'Data_(\w+)_(EMS_\w+)_(\d{8}_\d{6})\.csv', f)
+    for entry in entries:
+        match = _FILENAME_RE.match(entry.name)
         if not match:
             continue
         name, ems_status, timestamp = match.groups()
         if name not in subjects:
             subjects[name] = []
-        settings, df = parse_csv(os.path.join(DATA_DIR, f))
-        subjects[name].append({
-            'filename': f,
+        settings, df = load_csv_cached(entry.path)
+        subjects[name].append((timestamp, {
+            'filename': entry.name,
             'ems_status': ems_status,
             'timestamp': timestamp,
             'settings': settings,
             'data': df,
-        })
+        }))
 
-    # 時系列順にソート
+    # 時系列順にソート（抽出済みのタイムスタンプをキーにし、ソート後に外す）
     for name in subjects:
-        subjects[name].sort(key=lambda x: x['timestamp'])
+        subjects[name].sort(key=lambda x: x[0])
+        subjects[name] = [x[1] for x in subjects[name]]
 
     return subjects
 
@@ -130,57 +207,244 @@ def classify_phases(subject_files):
 # ============================================================
 # 外れ値除去
 # ============================================================
-def remove_outliers(series, label=""):
-    """IQR法 + 生理的制約による外れ値除去"""
-    original_n = len(series)
-
-    # 生理的制約: 100ms未満（予測的反応）、1000ms超（注意散漫）を除外
-    mask_physio = (series >= 100) & (series <= 1000)
-    cleaned = series[mask_physio]
-
-    # IQR法
-    q1 = cleaned.quantile(0.25)
-    q3 = cleaned.quantile(0.75)
-    iqr = q3 - q1
-    lower = q1 - 1.5 * iqr
-    upper = q3 + 1.5 * iqr
-    mask_iqr = (cleaned >= lower) & (cleaned <= upper)
-    cleaned = cleaned[mask_iqr]
-
-    removed = original_n - len(cleaned)
-    if removed > 0 and label:
-        print(f"    [{label}] 外れ値除去: {original_n} → {len(cleaned)} ({removed}件除外)")
+PHYSIO_MIN_MS = 100
+PHYSIO_MAX_MS = 1000
+
+
+def _percentile_linear(sorted_arr, q):
+    """np.percentile(method='linear') と同じ補間で分位点を求める"""
+    index = q * (len(sorted_arr) - 1)
+    lo = int(np.floor(index))
+    hi = min(lo + 1, len(sorted_arr) - 1)
+    t = index - lo
+    a = sorted_arr[lo]
+    diff = sorted_arr[hi] - a
+    if t >= 0.5:
+        return sorted_arr[hi] - diff * (1 - t)
+    return a + diff * t
+
+
+def _build_clean_kernel(njit):
+    """
+    _percentile_linear と外れ値除去カーネルをJITコンパイルして返す
+    モジュールの関数は差し替えず、カーネルはJIT版の分位点関数をクロージャで参照する
+    """
+    percentile = njit(cache=True)(_percentile_linear)
+
+    @njit(cache=True)
+    def clean_kernel(arr, out):
+        """生理的制約 → IQR法 の順に out へ詰め、残った件数を返す"""
+        n = 0
+        for x in arr:
+            if PHYSIO_MIN_MS <= x <= PHYSIO_MAX_MS:
+                out[n] = x
+                n += 1
+        if n == 0:
+            return 0
+
+        s = np.sort(out[:n])
+        q1 = percentile(s, 0.25)
+        q3 = percentile(s, 0.75)
+        iqr = q3 - q1
+        lower = q1 - 1.5 * iqr
+        upper = q3 + 1.5 * iqr
+
+        m = 0
+        for j in range(n):
+            x = out[j]
+            if lower <= x <= upper:
+                out[m] = x
+                m += 1
+        return m
+
+    return clean_kernel
+
+
+# 外れ値除去のJITカーネル（None: 未初期化, False: 無効またはnumbaが無いのでNumPy実装を使う）
+_clean_kernel_jit = None
+
+
+def _load_clean_kernel():
+    """USE_NUMBA のとき、初回呼び出しで numba を読み込んでカーネルを作り、以降は同じものを返す"""
+    global _clean_kernel_jit
+    if _clean_kernel_jit is None:
+        _clean_kernel_jit = False
+        if USE_NUMBA:
+            try:
+                from numba import njit
+            except ImportError:
+                pass
+            else:
+                _clean_kernel_jit = _build_clean_kernel(njit)
+    return _clean_kernel_jit
+
+
+def remove_outliers(arr, label=""):
+    """IQR法 + 生理的制約による外れ値除去（ndarrayを受け取りndarrayを返す）"""
+    arr = np.asarray(arr, dtype=np.float64)
+    original_n = len(arr)
+
+    kernel = _load_clean_kernel()
+    if kernel:
+        out = np.empty_like(arr)
+        cleaned = out[:kernel(arr, out)]
+    else:
+        # 生理的制約: 100ms未満（予測的反応）、1000ms超（注意散漫）を除外
+        cleaned = arr[(arr >= PHYSIO_MIN_MS) & (arr <= PHYSIO_MAX_MS)]
+
+        # IQR法（全件除外済みなら分位点は求めない）
+        if len(cleaned) > 0:
+            q1, q3 = np.percentile(cleaned, [25, 75])
+            iqr = q3 - q1
+            cleaned = cleaned[(cleaned >= q1 - 1.5 * iqr) & (cleaned <= q3 + 1.5 * iqr)]
+
+    if label:
+        _report_removed(label, original_n, len(cleaned))
 
     return cleaned
 
 
+def _report_removed(label, original_n, cleaned_n):
+    """外れ値除去の件数を表示する（除外がなければ何もしない）"""
+    removed = original_n - cleaned_n
+    if removed > 0:
+        print(f"    [{label}] 外れ値除去: {original_n} → {cleaned_n} ({removed}件除外)")
+
+
 # ============================================================
 # 被験者ごとの分析
 # ============================================================
-def analyze_subject(name, phases):
-    """被験者ごとの記述統計と検定"""
+PHASE_KEYS = ['baseline', 'measure_phase1', 'measure_phase2']
+PHASE_LABELS = ['ベースライン', 'フェーズ1後', 'フェーズ2後']
+
+# 被験者ごとの集計値（1被験者 = 1レコード、列ごとに連続した配列として保持）
+RESULT_DTYPE = np.dtype([
+    ('subject', object),
+    ('bl_mean', 'f8'), ('bl_sd', 'f8'), ('bl_median', 'f8'), ('bl_n', 'i4'),
+    ('p1_mean', 'f8'), ('p1_sd', 'f8'), ('p1_median', 'f8'), ('p1_n', 'i4'),
+    ('p2_mean', 'f8'), ('p2_sd', 'f8'), ('p2_median', 'f8'), ('p2_n', 'i4'),
+    ('change_p1', 'f8'), ('change_p2', 'f8'),
+    ('d_p1', 'f8'), ('p_p1', 'f8'),
+    ('d_p2', 'f8'), ('p_p2', 'f8'),
+])
+
+
+def clean_subject(phases):
+    """
+    ベースライン・フェーズ1後・フェーズ2後の試行を外れ値除去する
+    戻り値: (除去前の試行数のリスト, 除去後の配列のリスト)
+    """
+    raw = [phases[key]['data']['ReactionTime_ms'].to_numpy() for key in PHASE_KEYS]
+    return [len(r) for r in raw], [remove_outliers(r) for r in raw]
+
+
+def fast_mwu(x_sorted, y_sorted, alternative):
+    """
+    ソート済みの2標本で Mann-Whitney U 検定を行う（SciPyの漸近法と同じ計算）
+    U = R1 - n1(n1+1)/2 を y に対する x の位置（searchsorted）から直接求めるため、
+    結合標本を順位付けし直す必要がない
+    """
+    from scipy import special
+
+    n1, n2 = len(x_sorted), len(y_sorted)
+    below = np.searchsorted(y_sorted, x_sorted, side='left')
+    below_or_tied = np.searchsorted(y_sorted, x_sorted, side='right')
+    u1 = 0.5 * (below.sum() + below_or_tied.sum())
+
+    # 同順位の組（ソート済み2本のマージなので安定ソートはほぼ線形）
+    merged = np.concatenate([x_sorted, y_sorted])
+    merged.sort(kind='stable')
+    edges = np.flatnonzero(np.diff(merged)) + 1
+    t = np.diff(np.concatenate(([0], edges, [len(merged)]))).astype(np.float64)
+    has_ties = bool((t > 1).any())
+
+    # 小標本で同順位なしの場合はSciPyと同じく正確検定を使う
+    if (n1 <= 8 or n2 <= 8) and not has_ties:
+        from scipy import stats
+        res = stats.mannwhitneyu(x_sorted, y_sorted, alternative=alternative)
+        return res.statistic, res.pvalue
+
+    if alternative == 'greater':
+        u, f = u1, 1
+    elif alternative == 'less':
+        u, f = n1 * n2 - u1, 1
+    else:
+        u, f = max(u1, n1 * n2 - u1), 2
+
+    n = n1 + n2
+    tie_term = (t**3 - t).sum()
+    sd = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    z = (u - n1 * n2 / 2 - 0.5) / sd  # 連続性補正あり
+    return u1, min(max(special.ndtr(-z) * f, 0.0), 1.0)
+
+
+# 被験者数がこれ未満ならプロセス起動のコストの方が大きいので逐次処理する
+PARALLEL_MIN_SUBJECTS = 8
+
+
+def process_subject(phases):
+    """
+    1被験者分の外れ値除去と検定（表示は行わない）
+    ProcessPoolExecutor から呼べるようにモジュール直下に置く
+    戻り値: (除去前の試行数のリスト, 除去後の配列のリスト, [(U, p), (U, p), (U, p)])
+    """
+    raw_ns, cleaned = clean_subject(phases)
+    s_bl, s_p1, s_p2 = (np.sort(a) for a in cleaned)
+    mwu = [fast_mwu(s_bl, s_p1, 'greater'),
+           fast_mwu(s_bl, s_p2, 'greater'),
+           fast_mwu(s_p1, s_p2, 'greater')]
+    return raw_ns, cleaned, mwu
+
+
+def _describe(a):
+    """
+    平均・不偏分散・中央値・件数をまとめて求める
+    分散は偏差の内積から求め（二乗和からの引き算は桁落ちで負になりうる）、
+    中央値は np.partition（O(n)）で求める
+    """
+    n = len(a)
+    if n == 0:
+        return np.nan, np.nan, np.nan, 0
+    mean = a.sum() / n
+    d = a - mean
+    var = (d @ d) / (n - 1) if n > 1 else np.nan
+    k = n // 2
+    if n % 2:
+        median = np.partition(a, k)[k]
+    else:
+        part = np.partition(a, [k - 1, k])
+        median = 0.5 * (part[k - 1] + part[k])
+    return mean, var, median, n
+
+
+def _cohens_d(desc1, desc2):
+    """(平均, 分散, ...) の組2つから Cohen's d を求める"""
+    return (desc1[0] - desc2[0]) / np.sqrt((desc1[1] + desc2[1]) / 2)
+
+
+def analyze_subject(i, results, name, raw_ns, cleaned, mwu):
+    """
+    被験者ごとの記述統計と検定の表示（計算は process_subject で済ませてある）
+    集計値は results[i] に書き込む
+    """
     print(f"\n{'='*60}")
     print(f"  被験者: {name}")
     print(f"{'='*60}")
 
-    bl_raw = phases['baseline']['data']['ReactionTime_ms']
-    p1_raw = phases['measure_phase1']['data']['ReactionTime_ms']
-    p2_raw = phases['measure_phase2']['data']['ReactionTime_ms']
-
-    bl = remove_outliers(bl_raw, f"{name} ベースライン")
-    p1 = remove_outliers(p1_raw, f"{name} フェーズ1後")
-    p2 = remove_outliers(p2_raw, f"{name} フェーズ2後")
+    for label, raw_n, data in zip(PHASE_LABELS, raw_ns, cleaned):
+        _report_removed(f"{name} {label}", raw_n, len(data))
+    bl, p1, p2 = (_describe(data) for data in cleaned)
 
     # 記述統計
     print(f"\n  [記述統計]")
     print(f"  {'フェーズ':<16} {'平均(ms)':>10} {'SD':>10} {'中央値':>10} {'n':>5}")
     print(f"  {'-'*55}")
-    for label, data in [("ベースライン", bl), ("フェーズ1後", p1), ("フェーズ2後", p2)]:
-        print(f"  {label:<14} {data.mean():>10.2f} {data.std():>10.2f} {data.median():>10.2f} {len(data):>5}")
+    for label, (mean, var, median, n) in [("ベースライン", bl), ("フェーズ1後", p1), ("フェーズ2後", p2)]:
+        print(f"  {label:<14} {mean:>10.2f} {np.sqrt(var):>10.2f} {median:>10.2f} {n:>5}")
 
     # 変化量
-    change_p1 = bl.mean() - p1.mean()
-    change_p2 = bl.mean() - p2.mean()
+    change_p1 = bl[0] - p1[0]
+    change_p2 = bl[0] - p2[0]
     print(f"\n  [変化量（ベースラインからの短縮）]")
     print(f"  ベースライン → フェーズ1後: {change_p1:+.2f} ms")
     print(f"  ベースライン → フェーズ2後: {change_p2:+.2f} ms")
@@ -190,112 +454,154 @@ def analyze_subject(name, phases):
     # 対立仮説: 測定後の方が反応速度が速い（片側検定）
     print(f"\n  [Mann-Whitney U検定（片側: ベースライン > 測定後）]")
 
-    u1, p_val1 = stats.mannwhitneyu(bl, p1, alternative='greater')
-    d1 = (bl.mean() - p1.mean()) / np.sqrt((bl.std()**2 + p1.std()**2) / 2)
+    (u1, p_val1), (u2, p_val2), (u3, p_val3) = mwu
+    d1 = _cohens_d(bl, p1)
     print(f"  BL vs フェーズ1後: U={u1:.1f}, p={p_val1:.4f}, Cohen's d={d1:.3f}")
 
-    u2, p_val2 = stats.mannwhitneyu(bl, p2, alternative='greater')
-    d2 = (bl.mean() - p2.mean()) / np.sqrt((bl.std()**2 + p2.std()**2) / 2)
+    d2 = _cohens_d(bl, p2)
     print(f"  BL vs フェーズ2後: U={u2:.1f}, p={p_val2:.4f}, Cohen's d={d2:.3f}")
 
     # フェーズ1後 vs フェーズ2後
-    u3, p_val3 = stats.mannwhitneyu(p1, p2, alternative='greater')
-    d3 = (p1.mean() - p2.mean()) / np.sqrt((p1.std()**2 + p2.std()**2) / 2)
+    d3 = _cohens_d(p1, p2)
     print(f"  フェーズ1後 vs フェーズ2後: U={u3:.1f}, p={p_val3:.4f}, Cohen's d={d3:.3f}")
 
-    return {
-        'subject': name,
-        'bl_mean': bl.mean(), 'bl_sd': bl.std(), 'bl_median': bl.median(), 'bl_n': len(bl),
-        'p1_mean': p1.mean(), 'p1_sd': p1.std(), 'p1_median': p1.median(), 'p1_n': len(p1),
-        'p2_mean': p2.mean(), 'p2_sd': p2.std(), 'p2_median': p2.median(), 'p2_n': len(p2),
-        'change_p1': change_p1,
-        'change_p2': change_p2,
-        'd_p1': d1, 'p_p1': p_val1,
-        'd_p2': d2, 'p_p2': p_val2,
-        'bl_data': bl.values,
-        'p1_data': p1.values,
-        'p2_data': p2.values,
-    }
+    r = results[i]
+    r['subject'] = name
+    for prefix, (mean, var, median, n) in [('bl', bl), ('p1', p1), ('p2', p2)]:
+        r[f'{prefix}_mean'] = mean
+        r[f'{prefix}_sd'] = np.sqrt(var)
+        r[f'{prefix}_median'] = median
+        r[f'{prefix}_n'] = n
+    r['change_p1'] = change_p1
+    r['change_p2'] = change_p2
+    r['d_p1'], r['p_p1'] = d1, p_val1
+    r['d_p2'], r['p_p2'] = d2, p_val2
 
 
 # ============================================================
 # グループ分析
 # ============================================================
-def group_analysis(results_list):
-    """グループレベルの分析（n=3）"""
-    df = pd.DataFrame(results_list)
+GROUP_COLUMNS = ['bl_mean', 'p1_mean', 'p2_mean', 'change_p1', 'change_p2', 'd_p1', 'd_p2']
+
+
+def _group_aggregate(results):
+    """
+    GROUP_COLUMNS の被験者間の平均とSDを求める
+    戻り値: {'bl_mean_mean': ..., 'bl_mean_std': ..., ...}
+    """
+    try:
+        import polars as pl
+    except ImportError:
+        # polarsが無い環境ではNumPyで集計する
+        agg = {}
+        for c in GROUP_COLUMNS:
+            agg[f'{c}_mean'] = results[c].mean()
+            agg[f'{c}_std'] = results[c].std(ddof=1)
+        return agg
+
+    pdf = pl.DataFrame({c: results[c] for c in GROUP_COLUMNS})
+    row = pdf.select(
+        [pl.col(c).mean().alias(f'{c}_mean') for c in GROUP_COLUMNS]
+        + [pl.col(c).std().alias(f'{c}_std') for c in GROUP_COLUMNS]
+    ).row(0, named=True)
+    # n=1 のSDは None になるので NaN に揃える
+    return {k: np.nan if v is None else v for k, v in row.items()}
+
+
+def _flatten_phase(trials, k):
+    """全被験者の k 番目のフェーズの試行を、確保済みの1本の配列に詰めて返す"""
+    sizes = np.fromiter((len(t[k]) for t in trials), dtype=np.int64, count=len(trials))
+    offsets = np.zeros(len(trials) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    out = np.empty(offsets[-1], dtype=np.float64)
+    for i, t in enumerate(trials):
+        out[offsets[i]:offsets[i + 1]] = t[k]
+    return out
+
+
+def group_analysis(results, trials):
+    """
+    グループレベルの分析（n=3）
+    results は RESULT_DTYPE の構造化配列、trials は被験者ごとの (BL, P1後, P2後) 試行配列
+    戻り値: _group_aggregate の集計値
+    """
+    from scipy import stats
+
+    agg = _group_aggregate(results)
 
     print(f"\n{'='*60}")
-    print(f"  グループ分析 (n={len(df)})")
+    print(f"  グループ分析 (n={len(results)})")
     print(f"{'='*60}")
 
     # 記述統計
     print(f"\n  [グループ平均]")
-    print(f"  ベースライン平均: {df['bl_mean'].mean():.2f} ± {df['bl_mean'].std():.2f} ms")
-    print(f"  フェーズ1後平均:  {df['p1_mean'].mean():.2f} ± {df['p1_mean'].std():.2f} ms")
-    print(f"  フェーズ2後平均:  {df['p2_mean'].mean():.2f} ± {df['p2_mean'].std():.2f} ms")
+    print(f"  ベースライン平均: {agg['bl_mean_mean']:.2f} ± {agg['bl_mean_std']:.2f} ms")
+    print(f"  フェーズ1後平均:  {agg['p1_mean_mean']:.2f} ± {agg['p1_mean_std']:.2f} ms")
+    print(f"  フェーズ2後平均:  {agg['p2_mean_mean']:.2f} ± {agg['p2_mean_std']:.2f} ms")
 
     print(f"\n  [グループ変化量]")
-    print(f"  BL→フェーズ1後: {df['change_p1'].mean():+.2f} ± {df['change_p1'].std():.2f} ms")
-    print(f"  BL→フェーズ2後: {df['change_p2'].mean():+.2f} ± {df['change_p2'].std():.2f} ms")
+    print(f"  BL→フェーズ1後: {agg['change_p1_mean']:+.2f} ± {agg['change_p1_std']:.2f} ms")
+    print(f"  BL→フェーズ2後: {agg['change_p2_mean']:+.2f} ± {agg['change_p2_std']:.2f} ms")
 
     print(f"\n  [グループ効果量 (Cohen's d)]")
-    print(f"  BL vs フェーズ1後: d={df['d_p1'].mean():.3f}")
-    print(f"  BL vs フェーズ2後: d={df['d_p2'].mean():.3f}")
+    print(f"  BL vs フェーズ1後: d={agg['d_p1_mean']:.3f}")
+    print(f"  BL vs フェーズ2後: d={agg['d_p2_mean']:.3f}")
 
     # 対応ありt検定（参考値）
-    print(f"\n  [対応ありt検定（参考 - n={len(df)}では検出力不足）]")
-    if len(df) >= 2:
-        t1, pt1 = stats.ttest_rel(df['bl_mean'], df['p1_mean'])
-        t2, pt2 = stats.ttest_rel(df['bl_mean'], df['p2_mean'])
+    print(f"\n  [対応ありt検定（参考 - n={len(results)}では検出力不足）]")
+    if len(results) >= 2:
+        t1, pt1 = stats.ttest_rel(results['bl_mean'], results['p1_mean'])
+        t2, pt2 = stats.ttest_rel(results['bl_mean'], results['p2_mean'])
         print(f"  BL vs フェーズ1後: t={t1:.3f}, p={pt1:.4f}")
         print(f"  BL vs フェーズ2後: t={t2:.3f}, p={pt2:.4f}")
 
     # ウィルコクソン符号順位検定（参考値）
-    print(f"\n  [ウィルコクソン符号順位検定（参考 - n={len(df)}では最小p≈0.25）]")
+    print(f"\n  [ウィルコクソン符号順位検定（参考 - n={len(results)}では最小p≈0.25）]")
     try:
-        w1, pw1 = stats.wilcoxon(df['change_p1'], alternative='greater')
+        w1, pw1 = stats.wilcoxon(results['change_p1'], alternative='greater')
         print(f"  BL vs フェーズ1後: W={w1}, p={pw1:.4f}")
     except Exception as e:
         print(f"  BL vs フェーズ1後: 実行不可 ({e})")
     try:
-        w2, pw2 = stats.wilcoxon(df['change_p2'], alternative='greater')
+        w2, pw2 = stats.wilcoxon(results['change_p2'], alternative='greater')
         print(f"  BL vs フェーズ2後: W={w2}, p={pw2:.4f}")
     except Exception as e:
         print(f"  BL vs フェーズ2後: 実行不可 ({e})")
 
     # 全試行を統合した混合効果的な分析（被験者をブロック因子として）
     print(f"\n  [全試行統合分析（被験者をブロック因子としたKruskal-Wallis検定）]")
-    all_bl = np.concatenate([r['bl_data'] for r in results_list])
-    all_p1 = np.concatenate([r['p1_data'] for r in results_list])
-    all_p2 = np.concatenate([r['p2_data'] for r in results_list])
+    all_bl, all_p1, all_p2 = (_flatten_phase(trials, k) for k in range(3))
+    # 効果量用の平均・分散（全試行なので ddof=0）はフェーズごとに1回だけ求める
+    m_bl, m_p1, m_p2 = ((a.mean(), a.var()) for a in (all_bl, all_p1, all_p2))
+    # 事後検定では同じ配列を何度も比較するので、ソートも1回だけにする
+    s_bl, s_p1, s_p2 = (np.sort(a) for a in (all_bl, all_p1, all_p2))
 
     h_stat, h_p = stats.kruskal(all_bl, all_p1, all_p2)
     print(f"  Kruskal-Wallis H={h_stat:.3f}, p={h_p:.4f}")
 
     if h_p < 0.05:
         print(f"  → 有意差あり。事後検定（Mann-Whitney + Bonferroni補正）:")
-        pairs = [("BL vs P1後", all_bl, all_p1),
-                 ("BL vs P2後", all_bl, all_p2),
-                 ("P1後 vs P2後", all_p1, all_p2)]
-        for label, g1, g2 in pairs:
-            u, p_val = stats.mannwhitneyu(g1, g2, alternative='two-sided')
+        pairs = [("BL vs P1後", s_bl, s_p1, m_bl, m_p1),
+                 ("BL vs P2後", s_bl, s_p2, m_bl, m_p2),
+                 ("P1後 vs P2後", s_p1, s_p2, m_p1, m_p2)]
+        for label, s1, s2, m1, m2 in pairs:
+            u, p_val = fast_mwu(s1, s2, 'two-sided')
             p_corrected = min(p_val * 3, 1.0)  # Bonferroni
-            d = (g1.mean() - g2.mean()) / np.sqrt((g1.std()**2 + g2.std()**2) / 2)
+            d = _cohens_d(m1, m2)
             print(f"    {label}: U={u:.1f}, p(corrected)={p_corrected:.4f}, d={d:.3f}")
     else:
         # 片側検定も参考表示
         print(f"  → 有意差なし (p={h_p:.4f})")
         print(f"  [参考: 全試行統合 Mann-Whitney U（片側）]")
-        u1, pu1 = stats.mannwhitneyu(all_bl, all_p1, alternative='greater')
-        d1 = (all_bl.mean() - all_p1.mean()) / np.sqrt((all_bl.std()**2 + all_p1.std()**2) / 2)
+        u1, pu1 = fast_mwu(s_bl, s_p1, 'greater')
+        u2, pu2 = fast_mwu(s_bl, s_p2, 'greater')
+        d1 = _cohens_d(m_bl, m_p1)
         print(f"    BL vs P1後: U={u1:.1f}, p={pu1:.4f}, d={d1:.3f}")
 
-        u2, pu2 = stats.mannwhitneyu(all_bl, all_p2, alternative='greater')
-        d2 = (all_bl.mean() - all_p2.mean()) / np.sqrt((all_bl.std()**2 + all_p2.std()**2) / 2)
+        d2 = _cohens_d(m_bl, m_p2)
         print(f"    BL vs P2後: U={u2:.1f}, p={pu2:.4f}, d={d2:.3f}")
 
-    return df
+    return agg
 
 
 # ============================================================
@@ -306,23 +612,55 @@ def _anon_label(index):
     return f'被験者{index + 1}'
 
 
-def plot_results(results_list, output_dir="."):
-    """分析結果の可視化"""
-    df = pd.DataFrame(results_list)
-    subjects = [_anon_label(i) for i in range(len(df))]
+def _import_pyplot():
+    """matplotlib を初期設定して pyplot を返す（描画しない実行では読み込まない）"""
+    import matplotlib
+    matplotlib.use('Agg')  # ファイル出力のみなのでGUIバックエンドは不要
+    import matplotlib.pyplot as plt
+
+    # 日本語フォント設定（Windows）
+    matplotlib.rcParams['font.family'] = 'MS Gothic'
+    matplotlib.rcParams['axes.unicode_minus'] = False
+    # 描画の高速化（ラベルに数式は使わない）
+    matplotlib.rcParams.update({
+        'text.parse_math': False,
+        'path.simplify': True,
+        'path.simplify_threshold': 1.0,
+        'agg.path.chunksize': 10000,
+    })
+    return plt
+
 
-    fig, axes = plt.subplots(1, 3, figsize=(18, 6))
+def plot_results(results, trials, agg, output_dir="."):
+    """
+    分析結果の可視化（1枚の図にまとめて1回だけ保存する）
+    上段: グループ集計の3パネル / 下段: 被験者ごとの全トライアル散布図
+    results は RESULT_DTYPE の構造化配列、agg は group_analysis の集計値
+    保存後に図は閉じるので戻り値はない
+    """
+    plt = _import_pyplot()
+    subjects = [_anon_label(i) for i in range(len(results))]
+    n_subjects = len(trials)
+
+    fig = plt.figure(figsize=(max(18, 6 * n_subjects), 12))
+    # tight_layout / bbox_inches='tight' の追加描画を避けるため余白は固定で指定する
+    outer = fig.add_gridspec(2, 1, left=0.05, right=0.98, top=0.92, bottom=0.06, hspace=0.3)
+    top = outer[0].subgridspec(1, 3, wspace=0.25)
+    bottom = outer[1].subgridspec(1, n_subjects, wspace=0.25)
+    axes = [fig.add_subplot(top[0, k]) for k in range(3)]
     fig.suptitle('FPS反応速度実験 - EMS刺激トレーニング効果の検証', fontsize=14, fontweight='bold')
 
     # --- (1) 被験者ごとの平均反応速度推移 ---
     ax = axes[0]
     phases = ['ベースライン', 'フェーズ1後', 'フェーズ2後']
-    colors = ['#e74c3c', '#3498db', '#2ecc71']
-    markers = ['o', 's', '^']
-    for i, row in df.iterrows():
+    # 被験者数が色・マーカーの数を超えたら先頭から繰り返す
+    colors = ['#e74c3c', '#3498db', '#2ecc71', '#9b59b6', '#f39c12',
+              '#1abc9c', '#34495e', '#e67e22']
+    markers = ['o', 's', '^', 'D', 'v', 'P', 'X', '*']
+    for i, row in enumerate(results):
         vals = [row['bl_mean'], row['p1_mean'], row['p2_mean']]
-        ax.plot(phases, vals, marker=markers[i], markersize=10,
-                linewidth=2, label=_anon_label(i), color=colors[i])
+        ax.plot(phases, vals, marker=markers[i % len(markers)], markersize=10,
+                linewidth=2, label=_anon_label(i), color=colors[i % len(colors)])
     ax.set_ylabel('平均反応速度 (ms)')
     ax.set_title('(a) 被験者別 平均反応速度の推移')
     ax.legend()
@@ -330,8 +668,8 @@ def plot_results(results_list, output_dir="."):
 
     # --- (2) グループ平均の変化量（エラーバー付き） ---
     ax = axes[1]
-    change_means = [0, df['change_p1'].mean(), df['change_p2'].mean()]
-    change_sds = [0, df['change_p1'].std(), df['change_p2'].std()]
+    change_means = [0, agg['change_p1_mean'], agg['change_p2_mean']]
+    change_sds = [0, agg['change_p1_std'], agg['change_p2_std']]
     bar_colors = ['#95a5a6', '#3498db', '#2ecc71']
     bars = ax.bar(phases, change_means, yerr=change_sds, capsize=8,
                   color=bar_colors, alpha=0.8, edgecolor='black', linewidth=0.5)
@@ -349,9 +687,9 @@ def plot_results(results_list, output_dir="."):
     ax = axes[2]
     x = np.arange(len(subjects))
     width = 0.35
-    bars1 = ax.bar(x - width/2, df['change_p1'], width, label='フェーズ1後',
+    bars1 = ax.bar(x - width/2, results['change_p1'], width, label='フェーズ1後',
                    color='#3498db', alpha=0.8, edgecolor='black', linewidth=0.5)
-    bars2 = ax.bar(x + width/2, df['change_p2'], width, label='フェーズ2後',
+    bars2 = ax.bar(x + width/2, results['change_p2'], width, label='フェーズ2後',
                    color='#2ecc71', alpha=0.8, edgecolor='black', linewidth=0.5)
     ax.set_xticks(x)
     ax.set_xticklabels(subjects)
@@ -364,25 +702,13 @@ def plot_results(results_list, output_dir="."):
     ax.axhline(y=8, color='red', linestyle='--', linewidth=1, alpha=0.6, label='先行研究 (8ms)')
     ax.legend()
 
-    plt.tight_layout()
-    output_path = os.path.join(output_dir, 'reaction_time_analysis.png')
-    plt.savefig(output_path, dpi=150, bbox_inches='tight')
-    print(f"\nグラフを保存: {output_path}")
-    plt.close()
-
-
-def plot_individual_trials(results_list, output_dir="."):
-    """被験者ごとの全トライアル散布図"""
-    fig, axes = plt.subplots(1, len(results_list), figsize=(6 * len(results_list), 5))
-    if len(results_list) == 1:
-        axes = [axes]
-
-    for i, r in enumerate(results_list):
-        ax = axes[i]
+    # --- (4) 被験者ごとの全トライアル ---
+    for i, (bl, p1, p2) in enumerate(trials):
+        ax = fig.add_subplot(bottom[0, i])
         for j, (data, label, color) in enumerate([
-            (r['bl_data'], 'ベースライン', '#e74c3c'),
-            (r['p1_data'], 'フェーズ1後', '#3498db'),
-            (r['p2_data'], 'フェーズ2後', '#2ecc71'),
+            (bl, 'ベースライン', '#e74c3c'),
+            (p1, 'フェーズ1後', '#3498db'),
+            (p2, 'フェーズ2後', '#2ecc71'),
         ]):
             x = np.arange(len(data)) + 1
             ax.scatter(x, data, label=label, color=color, alpha=0.7, s=40)
@@ -390,25 +716,23 @@ def plot_individual_trials(results_list, output_dir="."):
 
         ax.set_xlabel('トライアル番号')
         ax.set_ylabel('反応速度 (ms)')
-        ax.set_title(f'{_anon_label(i)}')
+        ax.set_title(f'(d-{i + 1}) {_anon_label(i)} 全トライアルの反応速度')
         ax.legend(fontsize=8)
         ax.grid(True, alpha=0.3)
 
-    fig.suptitle('被験者別 全トライアルの反応速度', fontsize=13, fontweight='bold')
-    plt.tight_layout()
-    output_path = os.path.join(output_dir, 'individual_trials.png')
-    plt.savefig(output_path, dpi=150, bbox_inches='tight')
-    print(f"グラフを保存: {output_path}")
-    plt.close()
+    output_path = os.path.join(output_dir, 'reaction_time_analysis.png')
+    fig.savefig(output_path, dpi=PLOT_DPI)
+    print(f"\nグラフを保存: {output_path}")
+    plt.close(fig)
 
 
 # ============================================================
 # サマリーテーブル出力
 # ============================================================
-def export_summary(results_list, output_dir="."):
+def export_summary(results, output_dir="."):
     """結果をCSVで出力"""
     rows = []
-    for r in results_list:
+    for r in results:
         rows.append({
             '被験者': r['subject'],
             'BL_平均(ms)': round(r['bl_mean'], 2),
@@ -437,7 +761,12 @@ def export_summary(results_list, output_dir="."):
 # ============================================================
 # メイン
 # ============================================================
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FPS反応速度実験の統計分析")
+    parser.add_argument('--no-plot', action='store_true',
+                        help="グラフを描画しない（matplotlibを読み込まない）")
+    args = parser.parse_args(argv)
+
     print("=" * 60)
     print("  FPS反応速度実験 - EMS刺激トレーニング効果の統計分析")
     print("=" * 60)
@@ -447,21 +776,33 @@ def main():
     for name, files in subjects.items():
         print(f"  {name}: {len(files)} ファイル")
 
-    results_list = []
-    for name, files in subjects.items():
-        phases = classify_phases(files)
-        result = analyze_subject(name, phases)
-        results_list.append(result)
+    # 被験者ごとの計算は独立なので、人数が多ければプロセス並列で行う
+    # （表示は順序を保つためにここで逐次行う）
+    names = list(subjects)
+    phase_list = []
+    for name in names:
+        phases = classify_phases(subjects[name])
+        phase_list.append({key: phases[key] for key in PHASE_KEYS})
+    if len(names) >= PARALLEL_MIN_SUBJECTS:
+        with ProcessPoolExecutor() as ex:
+            processed = list(ex.map(process_subject, phase_list))
+    else:
+        processed = [process_subject(phases) for phases in phase_list]
+    trials = [c for _, c, _ in processed]
+
+    results = np.empty(len(names), dtype=RESULT_DTYPE)
+    for i, (name, (raw_ns, c, tests)) in enumerate(zip(names, processed)):
+        analyze_subject(i, results, name, raw_ns, c, tests)
 
-    df_group = group_analysis(results_list)
+    group = group_analysis(results, trials)
 
     # 可視化
     script_dir = os.path.dirname(os.path.abspath(__file__))
-    plot_results(results_list, output_dir=script_dir)
-    plot_individual_trials(results_list, output_dir=script_dir)
+    if not args.no_plot:
+        plot_results(results, trials, group, output_dir=script_dir)
 
     # CSV出力
-    df_summary = export_summary(results_list, output_dir=script_dir)
+    df_summary = export_summary(results, output_dir=script_dir)
     print(f"\n{'='*60}")
     print("  分析完了")
     print(f"{'='*60}")
@@ -470,13 +811,13 @@ def main():
 
     # 考察
     print(f"\n[考察]")
-    mean_change_p2 = df_group['change_p2'].mean()
+    mean_change_p2 = group['change_p2_mean']
     if mean_change_p2 > 0:
         print(f"  グループ平均で {mean_change_p2:.1f}ms の反応速度短縮が観察されました。")
         print(f"  先行研究の8ms短縮と比較して、方向性は{'一致' if mean_change_p2 > 0 else '不一致'}しています。")
     else:
         print(f"  グループ平均で反応速度の短縮は観察されませんでした（{mean_change_p2:+.1f}ms）。")
-    print(f"  ※ n={len(df_group)}のため統計的有意性の主張は困難です。効果量を重視した解釈を推奨します。")
+    print(f"  ※ n={len(results)}のため統計的有意性の主張は困難です。効果量を重視した解釈を推奨します。")
 
 
 if __name__ == '__main__':
@@ -34,49 +34,75 @@ PULSE_INTERVAL_US = 40000 # インターバル (μs)
 # 時間分解能
 DT = 1  # 1μs刻み
 
+# 出力解像度（確認用に素早く描くときは環境変数 PLOT_DPI=100 などで下げる）
+PLOT_DPI = int(os.environ.get('PLOT_DPI', 150))
+
 # ============================================================
 # 波形生成
 # ============================================================
-def generate_biphasic_waveform():
-    """2相性パルス波形を生成"""
-    waveform = []
-    time = []
-    t = 0
-
-    for rep in range(PULSE_COUNT):
-        for burst in range(BURST_COUNT):
-            # 1. 正相 (+1)
-            for _ in range(PULSE_WIDTH_US):
-                time.append(t)
-                waveform.append(1.0)
-                t += DT
-
-            # 2. 休止 (0)
-            for _ in range(PULSE_WIDTH_US):
-                time.append(t)
-                waveform.append(0.0)
-                t += DT
-
-            # 3. 逆相 (-1)
-            for _ in range(PULSE_WIDTH_US):
-                time.append(t)
-                waveform.append(-1.0)
-                t += DT
-
-            # 4. 休止 (0)
-            for _ in range(PULSE_WIDTH_US):
-                time.append(t)
-                waveform.append(0.0)
-                t += DT
-
-        # インターバル（最後の繰り返し以外）
-        if rep < PULSE_COUNT - 1:
-            for _ in range(PULSE_INTERVAL_US):
-                time.append(t)
-                waveform.append(0.0)
-                t += DT
-
-    return np.array(time), np.array(waveform)
+# パック形式（ロジックアナライザ/トリガファイル向け）: 1サンプル2ビット、uint64に32サンプル
+PHASE_PLUS, PHASE_ZERO, PHASE_MINUS = 0b01, 0b00, 0b11
+SAMPLES_PER_WORD = 32
+_WORD_SHIFTS = (2 * np.arange(SAMPLES_PER_WORD)).astype(np.uint64)
+
+
+def _tile_stimulus(phase_values):
+    """1サイクル4相の値 [正相, 休止, 逆相, 休止] を刺激全体の系列に展開する"""
+    cycle = np.repeat(phase_values, PULSE_WIDTH_US)
+    burst = np.tile(cycle, BURST_COUNT)
+
+    # インターバル（最後の繰り返し以外）を挟んでバーストを連結
+    if PULSE_COUNT > 1:
+        gap = np.full(PULSE_INTERVAL_US, phase_values[1])
+        return np.concatenate([burst] + [np.concatenate([gap, burst])] * (PULSE_COUNT - 1))
+    return burst
+
+
+def _or_lanes(lanes, words):
+    """(語数, 32) の uint8 相コードを1列ずつシフトして words に OR する（一時配列は語数分まで）"""
+    for k in range(SAMPLES_PER_WORD):
+        words |= lanes[:, k].astype(np.uint64) << _WORD_SHIFTS[k]
+
+
+def pack_phase_codes(codes):
+    """2ビットの相コード列を uint64 に32サンプルずつ詰める（末尾は休止で埋める）"""
+    codes = np.asarray(codes, dtype=np.uint8)
+    n_full = codes.size // SAMPLES_PER_WORD
+    n_words = -(-codes.size // SAMPLES_PER_WORD)
+    words = np.zeros(n_words, dtype=np.uint64)
+    # 32の倍数までは uint8 のまま (語数, 32) に並べ替えて詰める（コピーしない）
+    _or_lanes(codes[:n_full * SAMPLES_PER_WORD].reshape(n_full, SAMPLES_PER_WORD), words[:n_full])
+    # 端数の1語だけ休止で埋めてから詰める
+    if n_words > n_full:
+        tail = np.full((1, SAMPLES_PER_WORD), PHASE_ZERO, dtype=np.uint8)
+        tail[0, :codes.size - n_full * SAMPLES_PER_WORD] = codes[n_full * SAMPLES_PER_WORD:]
+        _or_lanes(tail, words[n_full:])
+    return words
+
+
+def unpack_waveform(packed, n_samples):
+    """pack_phase_codes の結果を正規化電圧（+1/0/-1 の float 配列）に戻す"""
+    codes = (packed[:, None] >> _WORD_SHIFTS) & np.uint64(0b11)
+    levels = np.zeros(4)
+    levels[PHASE_PLUS] = 1.0
+    levels[PHASE_MINUS] = -1.0
+    return levels[codes.reshape(-1)[:n_samples]]
+
+
+def generate_biphasic_waveform(packed=False):
+    """
+    2相性パルス波形を生成
+    packed=False: (時間[μs], 電圧) の配列を返す
+    packed=True:  (uint64 にパックした相コード, サンプル数) を返す（float64 の 1/32 のメモリ）
+    """
+    if packed:
+        codes = _tile_stimulus(np.array([PHASE_PLUS, PHASE_ZERO, PHASE_MINUS, PHASE_ZERO], dtype=np.uint8))
+        return pack_phase_codes(codes), codes.size
+
+    # 1サイクル: 正相(+1) → 休止(0) → 逆相(-1) → 休止(0)
+    waveform = _tile_stimulus(np.array([1.0, 0.0, -1.0, 0.0]))
+    time = np.arange(waveform.size) * DT
+    return time, waveform
 
 
 def plot_waveform():
@@ -84,6 +110,8 @@ def plot_waveform():
     time_us, waveform = generate_biphasic_waveform()
 
     fig, axes = plt.subplots(2, 1, figsize=(14, 8), gridspec_kw={'height_ratios': [1, 1]})
+    # tight_layout / bbox_inches='tight' の追加描画を避けるため余白は固定で指定する
+    fig.subplots_adjust(left=0.06, right=0.98, top=0.89, bottom=0.08, hspace=0.35)
     fig.suptitle('EMS刺激 電圧波形（2相性パルス, Biphasic）', fontsize=14, fontweight='bold')
 
     # ========== (a) 全体波形 ==========
@@ -166,12 +194,10 @@ def plot_waveform():
                     color=color,
                     bbox=dict(boxstyle='round,pad=0.2', facecolor='white', edgecolor=color, alpha=0.6))
 
-    plt.tight_layout()
-
     output_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ems_waveform.png')
-    plt.savefig(output_path, dpi=150, bbox_inches='tight')
+    fig.savefig(output_path, dpi=PLOT_DPI)
     print(f"波形図を保存: {output_path}")
-    plt.close()
+    plt.close(fig)
 
 
 if __name__ == '__main__':